@@ -1,14 +1,15 @@
-import os
-from openai import OpenAI
 from PIL import Image
-import base64
 import json
 import logging
-import re
 import numpy as np
-import cv2
 import traceback
 
+# orjson is optional, it parses the model responses faster than the json module
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Set up logger
 logger = logging.getLogger('receipt_extractor.extract')
 
@@ -23,24 +24,37 @@ def extract_receipts(image_path, bounding_boxes):
     Returns:
         list: A list of extracted receipt images.
     """
+    return [receipt for _, receipt in iter_receipts(image_path, bounding_boxes)]
+
+def iter_receipts(image_path, bounding_boxes):
+    """
+    Lazily extract receipts from an image using bounding boxes.
+    
+    Each receipt is cropped only when it is requested, so a caller that saves
+    and drops the receipts one by one never holds more than one crop.
+    
+    Args:
+        image_path (str): The path to the image.
+        bounding_boxes (list): A list of bounding boxes.
+        
+    Yields:
+        tuple: The index of the extracted receipt (0-based) and its image.
+    """
     try:
         logger.info(f"Extracting receipts from {image_path} with {len(bounding_boxes)} bounding boxes")
         
         # Load the image
         try:
             image = Image.open(image_path)
-            image_np = np.array(image)
+            image.load()
         except Exception as e:
             logger.error(f"Failed to open image {image_path}: {str(e)}")
-            return []
+            return
         
-        # Convert to BGR for OpenCV
-        if len(image_np.shape) == 3 and image_np.shape[2] == 4:  # RGBA
-            image_np = cv2.cvtColor(image_np, cv2.COLOR_RGBA2BGR)
-        elif len(image_np.shape) == 3 and image_np.shape[2] == 3:  # RGB
-            image_np = cv2.cvtColor(image_np, cv2.COLOR_RGB2BGR)
-        
-        receipts = []
+        # Collect the raw coordinates of every bounding box, 4-point boxes are padded to 8 values
+        all_coords = []
+        box_indices = []
+        rotated = []
         
         for i, bbox in enumerate(bounding_boxes):
             try:
@@ -60,68 +74,98 @@ def extract_receipts(image_path, bounding_boxes):
                     logger.warning(f"Unrecognized bounding box format: {bbox}")
                     continue
                 
-                # Convert coordinates to integers
+                # Convert coordinates to numbers
                 try:
                     if len(coordinates) == 4:  # [x, y, width, height] or [x1, y1, x2, y2]
-                        x1, y1, x2, y2 = coordinates
-                        # Check if it's [x, y, width, height]
-                        if x2 < x1 or y2 < y1:
-                            x2, y2 = x1 + x2, y1 + y2
+                        box = [float(c) for c in coordinates] + [0.0] * 4
                     elif len(coordinates) == 8:  # [x1, y1, x2, y2, x3, y3, x4, y4]
-                        # For rotated bounding boxes, we need to find the min/max coordinates
-                        xs = coordinates[0::2]
-                        ys = coordinates[1::2]
-                        x1, y1, x2, y2 = min(xs), min(ys), max(xs), max(ys)
+                        box = [float(c) for c in coordinates]
                     else:
                         logger.warning(f"Unexpected coordinate format: {coordinates}")
                         continue
                         
-                    # Convert to integers
-                    x1, y1, x2, y2 = int(x1), int(y1), int(x2), int(y2)
-                    
-                    # Ensure coordinates are within image bounds
-                    height, width = image_np.shape[:2]
-                    x1 = max(0, x1)
-                    y1 = max(0, y1)
-                    x2 = min(width, x2)
-                    y2 = min(height, y2)
-                    
-                    # Check if the bounding box is valid
-                    if x1 >= x2 or y1 >= y2:
-                        logger.warning(f"Invalid bounding box dimensions: ({x1}, {y1}, {x2}, {y2})")
-                        continue
-                        
                 except (ValueError, TypeError) as e:
                     logger.error(f"Error processing coordinates {coordinates}: {str(e)}")
                     continue
                 
-                # Crop the image
-                try:
-                    cropped = image_np[y1-20:y2+20, x1-20:x2+20]
-                    if cropped.size == 0:
-                        logger.warning(f"Cropped image is empty for bbox {i+1}")
-                        continue
-                        
-                    # Convert back to RGB for PIL
-                    cropped_rgb = cv2.cvtColor(cropped, cv2.COLOR_BGR2RGB)
-                    receipt = Image.fromarray(cropped_rgb)
-                    receipts.append(receipt)
-                    logger.debug(f"Successfully extracted receipt {i+1} with dimensions {receipt.size}")
-                except Exception as e:
-                    logger.error(f"Error cropping image for bbox {i+1}: {str(e)}")
-                    continue
+                all_coords.append(box)
+                box_indices.append(i)
+                rotated.append(len(coordinates) == 8)
                     
             except Exception as e:
                 logger.error(f"Error processing bounding box {i+1}: {str(e)}")
                 continue
         
-        logger.info(f"Successfully extracted {len(receipts)} receipts from {image_path}")
-        return receipts
+        # Normalize, convert and clip all bounding boxes at once
+        raw_coords = np.asarray(all_coords, dtype=np.float64).reshape(-1, 8)
+        box_indices = np.asarray(box_indices, dtype=np.intp)
+        rotated = np.asarray(rotated, dtype=bool)
+        
+        # For rotated bounding boxes, we need to find the min/max coordinates
+        coords = raw_coords[:, :4].copy()
+        rotated_coords = raw_coords[rotated]
+        coords[rotated, 0] = rotated_coords[:, 0::2].min(axis=1)
+        coords[rotated, 1] = rotated_coords[:, 1::2].min(axis=1)
+        coords[rotated, 2] = rotated_coords[:, 0::2].max(axis=1)
+        coords[rotated, 3] = rotated_coords[:, 1::2].max(axis=1)
+        
+        # Boxes with x2 < x1 or y2 < y1 are [x, y, width, height]
+        xywh = (coords[:, 2] < coords[:, 0]) | (coords[:, 3] < coords[:, 1])
+        coords[xywh, 2:] += coords[xywh, :2]
+        
+        # Drop non-finite coordinates
+        finite = np.isfinite(coords).all(axis=1)
+        if not finite.all():
+            logger.warning(f"Skipping {np.count_nonzero(~finite)} bounding boxes with non-finite coordinates")
+        coords = coords[finite]
+        box_indices = box_indices[finite]
+        
+        # Ensure coordinates are within image bounds, then convert to integers
+        width, height = image.size
+        np.clip(coords[:, 0::2], 0, width, out=coords[:, 0::2])
+        np.clip(coords[:, 1::2], 0, height, out=coords[:, 1::2])
+        coords = coords.astype(np.int32)
+        
+        # Check if the bounding boxes are valid
+        valid = (coords[:, 0] < coords[:, 2]) & (coords[:, 1] < coords[:, 3])
+        for x1, y1, x2, y2 in coords[~valid]:
+            logger.warning(f"Invalid bounding box dimensions: ({x1}, {y1}, {x2}, {y2})")
+        
+        # Add a 20 pixel margin around each receipt, clamped so crops never extend past the image
+        crop_boxes = coords[valid] + np.array([-20, -20, 20, 20], dtype=np.int32)
+        np.clip(crop_boxes[:, 0::2], 0, width, out=crop_boxes[:, 0::2])
+        np.clip(crop_boxes[:, 1::2], 0, height, out=crop_boxes[:, 1::2])
+        
+        num_receipts = 0
+        
+        for i, crop_box in zip(box_indices[valid].tolist(), crop_boxes.tolist()):
+            # Crop the image
+            try:
+                receipt = image.crop(tuple(crop_box))
+                
+                # Drop the alpha channel, compositing onto white if the receipt is not fully opaque
+                if receipt.mode == "RGBA":
+                    alpha = receipt.getchannel("A")
+                    if alpha.getextrema() == (255, 255):
+                        receipt = receipt.convert("RGB")
+                    else:
+                        background = Image.new("RGB", receipt.size, (255, 255, 255))
+                        background.paste(receipt, mask=alpha)
+                        receipt = background
+                    
+                logger.debug(f"Successfully extracted receipt {i+1} with dimensions {receipt.size}")
+            except Exception as e:
+                logger.error(f"Error cropping image for bbox {i+1}: {str(e)}")
+                continue
+                
+            yield num_receipts, receipt
+            num_receipts += 1
+        
+        logger.info(f"Successfully extracted {num_receipts} receipts from {image_path}")
         
     except Exception as e:
         logger.error(f"Error extracting receipts from {image_path}: {str(e)}")
         logger.debug(traceback.format_exc())
-        return []
 
 def create_qwen_vl_request(model, image_base64, prompt, system_prompt=None):
     """
@@ -167,6 +211,42 @@ def create_qwen_vl_request(model, image_base64, prompt, system_prompt=None):
         logger.error(f"Error creating request: {str(e)}")
         raise
 
+def _json_loads(json_str):
+    """
+    Parse a JSON string with orjson when it is installed, otherwise with json.
+    
+    Args:
+        json_str (str): The JSON string.
+        
+    Returns:
+        The parsed JSON data.
+        
+    Raises:
+        json.JSONDecodeError: If the string is not valid JSON.
+    """
+    if orjson is not None:
+        return orjson.loads(json_str)
+    return json.loads(json_str)
+
+def _find_json_code_block(response_content):
+    """
+    Find the contents of the first ```json markdown code block.
+    
+    Args:
+        response_content (str): The response content from the model.
+        
+    Returns:
+        str: The stripped code block contents, or None if there is no complete block.
+    """
+    start = response_content.find("```json")
+    if start == -1:
+        return None
+    start += len("```json")
+    end = response_content.find("```", start)
+    if end == -1:
+        return None
+    return response_content[start:end].strip()
+
 def get_bounding_boxes_from_response(response_content):
     """
     Extract bounding boxes from the model response.
@@ -180,22 +260,24 @@ def get_bounding_boxes_from_response(response_content):
     try:
         logger.debug("Extracting bounding boxes from response")
         
-        # Try to find JSON in the response
-        json_match = re.search(r'```json\s*([\s\S]*?)\s*```', response_content)
-        if json_match:
-            json_str = json_match.group(1)
-            logger.debug("Found JSON in markdown code block")
-        else:
-            # If no JSON code block, try to parse the entire response
-            json_str = response_content
-            logger.debug("No JSON code block found, trying to parse entire response")
-        
         # Clean up the JSON string
-        json_str = json_str.strip()
+        json_str = response_content.strip()
         
         # Parse the JSON
         try:
-            data = json.loads(json_str)
+            try:
+                # Many responses are plain JSON, so try to parse the entire response first
+                data = _json_loads(json_str)
+                logger.debug("Parsed entire response as JSON")
+            except json.JSONDecodeError:
+                # Otherwise try to find JSON in a markdown code block
+                code_block = _find_json_code_block(response_content)
+                if code_block is None:
+                    logger.debug("No JSON code block found in response")
+                    raise
+                json_str = code_block
+                logger.debug("Found JSON in markdown code block")
+                data = _json_loads(json_str)
             
             # Handle different JSON structures
             if isinstance(data, list):
@@ -3,11 +3,9 @@ import os
 import sys
 import logging
 from openai import OpenAI
-from PIL import Image
 import base64
 import json
-import extract_receipts as extract_receipts
-from pdf2img import PDFtoPNGConverter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 
 def setup_logging(log_level=logging.INFO):
@@ -23,6 +21,17 @@ def setup_logging(log_level=logging.INFO):
     return logging.getLogger('receipt_extractor')
 
 
+def positive_int(value):
+    """Argparse type for options that must be a positive integer."""
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid int value: '{value}'")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
+
+
 def main():
     logger = setup_logging()
     
@@ -34,6 +43,9 @@ def main():
     parser.add_argument("--output_receipts", default="output/receipts", help="Output folder for the extracted receipts")
     parser.add_argument("--extract_pages_disabled", action="store_true", help="Disable extracting pages from the PDF file (in case the pages are already extracted)")
     parser.add_argument("--list_models", action="store_true", help="List available models")   
+    parser.add_argument("--max_workers", type=positive_int, default=8, help="Number of pages processed concurrently")
+    parser.add_argument("--conversion_workers", type=positive_int, default=None,
+                        help="Number of PDF pages enhanced and encoded concurrently (default: CPU count, at most 4)")
     parser.add_argument("--log_level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"], 
                         help="Set the logging level")
     # Parse command-line arguments
@@ -71,6 +83,10 @@ def main():
                 logger.error(f"Failed to list models: {str(e)}")
                 return 1
 
+        # Imported here so that listing models does not load PyMuPDF, NumPy and Pillow
+        import extract_receipts
+        from pdf2img import PDFtoPNGConverter
+
         # Define input and output folders
         input_folder = args.input_folder
         output_pages = args.output_pages
@@ -91,8 +107,8 @@ def main():
                 pdf_path = os.path.join(input_folder, pdf_filename)
                 logger.info(f"Extracting pages from {pdf_filename}...")
                 try:
-                    converter = PDFtoPNGConverter(pdf_path, output_pages, dpi=300, image_format="png", quality=94, contrast_factor=2)
-                    converter.convert_all_pages_to_png()
+                    with PDFtoPNGConverter(pdf_path, output_pages, dpi=300, image_format="png", quality=94, contrast_factor=2, max_workers=args.conversion_workers) as converter:
+                        converter.convert_all_pages_to_png()
                 except Exception as e:
                     logger.error(f"Error converting PDF {pdf_filename}: {str(e)}")
 
@@ -106,15 +122,17 @@ def main():
             logger.warning(f"No image files found in {output_pages}")
             return 0
 
-        # Iterate over each image in the output_folder
-        for filename in image_files:
+        def process_page(filename):
+            """Detect, extract and save the receipts of a single page image."""
             logger.info(f"Extracting receipts from page {filename}...")
             image_path = os.path.join(output_pages, filename)
 
             try:
-                # Load your image as base64
+                # Load your image as base64, releasing the raw bytes before the request is built
                 with open(image_path, "rb") as f:
-                    image_base64 = base64.b64encode(f.read()).decode()
+                    image_bytes = f.read()
+                image_base64 = base64.b64encode(image_bytes).decode("ascii")
+                del image_bytes
 
                 # Create the request
                 request = extract_receipts.create_qwen_vl_request(
@@ -138,15 +156,16 @@ def main():
 
                 # Check if bounding_boxes is not empty
                 if bounding_boxes:
-                    # Extract receipts using the bounding boxes
-                    receipts = extract_receipts.extract_receipts(image_path, bounding_boxes)
-
-                    # Save the receipts
-                    logger.info(f"Saving {len(receipts)} receipts from {filename}...")
-                    for i, receipt in enumerate(receipts):
+                    # Extract receipts using the bounding boxes and save each one as soon as it is cropped
+                    logger.info(f"Saving receipts from {filename}...")
+                    num_receipts = 0
+                    for i, receipt in extract_receipts.iter_receipts(image_path, bounding_boxes):
                         receipt_path = os.path.join(output_receipts, f"receipt_{filename}_{i+1}.png")
-                        receipt.save(receipt_path)
+                        # A lower zlib level than the default 6 encodes much faster for a slightly larger file
+                        receipt.save(receipt_path, compress_level=3)
                         logger.info(f"Saved receipt {i+1} to {receipt_path}")
+                        num_receipts += 1
+                    return num_receipts
                 else:
                     logger.warning(f"No bounding boxes found in the response for {filename}.")
                     
@@ -156,6 +175,19 @@ def main():
                 logger.error(f"Failed to parse JSON response for {filename}")
             except Exception as e:
                 logger.error(f"Error processing {filename}: {str(e)}")
+            return 0
+
+        # Process the images in the output_folder concurrently, the API calls dominate the runtime
+        with ThreadPoolExecutor(max_workers=args.max_workers) as executor:
+            futures = [executor.submit(process_page, filename) for filename in image_files]
+            try:
+                num_receipts = sum(future.result() for future in as_completed(futures))
+            except KeyboardInterrupt:
+                # Cancel the queued pages, leaving the executor then only waits for the pages in progress
+                for future in futures:
+                    future.cancel()
+                raise
+        logger.info(f"Extracted {num_receipts} receipts from {len(image_files)} pages")
                 
         return 0
         
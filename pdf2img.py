@@ -1,19 +1,24 @@
 import os
 import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import fitz  # PyMuPDF
-from PIL import Image, ImageEnhance
+from PIL import Image
 import numpy as np
 import traceback
 
 # Set up logger
 logger = logging.getLogger('receipt_extractor.pdf2img')
 
+# Each worker holds a few full-page buffers (~26 MB each at 300 DPI), so the default is capped
+DEFAULT_MAX_WORKERS = 4
+
 class PDFtoPNGConverter:
     """
     A class to convert PDF pages to PNG images with various enhancement options.
     """
     
-    def __init__(self, pdf_path, output_folder, dpi=300, image_format="png", quality=95, contrast_factor=1.0):
+    def __init__(self, pdf_path, output_folder, dpi=300, image_format="png", quality=95, contrast_factor=1.0, max_workers=None):
         """
         Initialize the PDF to PNG converter.
         
@@ -24,6 +29,8 @@ class PDFtoPNGConverter:
             image_format (str): Format for the output images (png, jpg, etc.).
             quality (int): Quality for the output images (0-100).
             contrast_factor (float): Contrast enhancement factor.
+            max_workers (int): Number of threads used to enhance and encode pages
+                (defaults to the CPU count, at most DEFAULT_MAX_WORKERS).
         """
         self.pdf_path = pdf_path
         self.output_folder = output_folder
@@ -31,6 +38,12 @@ class PDFtoPNGConverter:
         self.image_format = image_format.lower()
         self.quality = quality
         self.contrast_factor = contrast_factor
+        self.max_workers = max_workers or min(os.cpu_count() or 1, DEFAULT_MAX_WORKERS)
+        self._levels = np.arange(256, dtype=np.float32)
+        
+        # Create a matrix for rendering at the specified DPI (default is 72 DPI)
+        zoom_factor = dpi / 72
+        self._matrix = fitz.Matrix(zoom_factor, zoom_factor)
         
         # Validate inputs
         if not os.path.exists(pdf_path):
@@ -45,8 +58,29 @@ class PDFtoPNGConverter:
                 logger.error(f"Failed to create output folder: {str(e)}")
                 raise
                 
+        # Open the PDF file once, it is reused for every page conversion
+        try:
+            self._doc = fitz.open(pdf_path)
+            self._num_pages = len(self._doc)
+        except Exception as e:
+            logger.error(f"Failed to open PDF file: {str(e)}")
+            raise
+                
         logger.info(f"Initialized PDF converter for {pdf_path} with DPI={dpi}, format={image_format}, quality={quality}")
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def close(self):
+        """
+        Close the underlying PDF document.
+        """
+        if not self._doc.is_closed:
+            self._doc.close()
+
     def convert_page_to_png(self, page_num):
         """
         Convert a specific page of the PDF to a PNG image.
@@ -58,101 +92,168 @@ class PDFtoPNGConverter:
             str: Path to the saved image file.
         """
         try:
-            # Extract the PDF filename without extension
-            pdf_filename = os.path.splitext(os.path.basename(self.pdf_path))[0]
-            output_filename = f"{pdf_filename}_page_{page_num + 1}.{self.image_format}"
-            output_path = os.path.join(self.output_folder, output_filename)
-            
-            logger.info(f"Converting page {page_num + 1} to {self.image_format}")
-            
-            # Open the PDF file
-            try:
-                pdf_document = fitz.open(self.pdf_path)
-            except Exception as e:
-                logger.error(f"Failed to open PDF file: {str(e)}")
-                return None
-                
             # Check if page number is valid
-            if page_num < 0 or page_num >= len(pdf_document):
-                logger.error(f"Invalid page number {page_num + 1}. PDF has {len(pdf_document)} pages.")
-                pdf_document.close()
+            if not 0 <= page_num < self._num_pages:
+                logger.error(f"Invalid page number {page_num + 1}. PDF has {self._num_pages} pages.")
                 return None
                 
-            try:
-                # Get the specified page
-                page = pdf_document[page_num]
-                
-                # Calculate the zoom factor based on DPI (default is 72 DPI)
-                zoom_factor = self.dpi / 72
-                
-                # Create a matrix for rendering at the specified DPI
-                matrix = fitz.Matrix(zoom_factor, zoom_factor)
-                
-                # Render the page to a pixmap
-                pixmap = page.get_pixmap(matrix=matrix, alpha=False)
-                
-                # Convert the pixmap to a PIL Image
-                img = Image.frombytes("RGB", [pixmap.width, pixmap.height], pixmap.samples)
-                
-                # Apply contrast enhancement if needed
-                if self.contrast_factor != 1.0:
-                    logger.debug(f"Applying contrast enhancement with factor {self.contrast_factor}")
-                    enhancer = ImageEnhance.Contrast(img)
-                    img = enhancer.enhance(self.contrast_factor)
-                
-                # Save the image
-                if self.image_format == "jpg" or self.image_format == "jpeg":
-                    img.save(output_path, format="JPEG", quality=self.quality)
-                elif self.image_format == "png":
-                    img.save(output_path, format="PNG", quality=self.quality)
-                else:
-                    img.save(output_path)
-                    
-                logger.info(f"Saved page {page_num + 1} to {output_path}")
+            output_path, pixmap = self._render_page(page_num)
+            if pixmap is None:
                 return output_path
-                
-            except Exception as e:
-                logger.error(f"Error processing page {page_num + 1}: {str(e)}")
-                logger.debug(traceback.format_exc())
-                return None
-                
-            finally:
-                # Close the PDF document
-                pdf_document.close()
+            return self._save_samples(pixmap.samples_mv, pixmap.width, pixmap.height, page_num, output_path)
                 
         except Exception as e:
             logger.error(f"Unexpected error converting page {page_num + 1}: {str(e)}")
             logger.debug(traceback.format_exc())
             return None
 
+    def _render_page(self, page_num):
+        """
+        Render a page of the PDF to a pixmap.
+        
+        PyMuPDF is not thread safe, so this must only be called from the thread
+        that owns the converter. When the page needs no processing by PIL it is
+        written straight to disk by PyMuPDF.
+        
+        Args:
+            page_num (int): The page number to render (0-based).
+            
+        Returns:
+            tuple: Path to the image file and the rendered pixmap, or None as the
+                pixmap if the page has already been saved.
+        """
+        # Extract the PDF filename without extension
+        pdf_filename = os.path.splitext(os.path.basename(self.pdf_path))[0]
+        output_filename = f"{pdf_filename}_page_{page_num + 1}.{self.image_format}"
+        output_path = os.path.join(self.output_folder, output_filename)
+        
+        logger.info(f"Converting page {page_num + 1} to {self.image_format}")
+        
+        # Render the page to a pixmap
+        pixmap = self._doc[page_num].get_pixmap(matrix=self._matrix, alpha=False)
+        
+        # Without enhancement PyMuPDF can write the PNG straight from the pixmap
+        if self.contrast_factor == 1.0 and self.image_format == "png":
+            pixmap.save(output_path, output="png")
+            logger.info(f"Saved page {page_num + 1} to {output_path}")
+            return output_path, None
+            
+        return output_path, pixmap
+
+    def _save_samples(self, samples, width, height, page_num, output_path):
+        """
+        Enhance and save the raw RGB samples of a rendered page.
+        
+        Makes no PyMuPDF calls, so it can run on a worker thread. The caller must
+        keep the pixmap that owns the samples alive until this returns.
+        
+        Args:
+            samples (memoryview): Interleaved RGB samples of the page.
+            width (int): Width of the page in pixels.
+            height (int): Height of the page in pixels.
+            page_num (int): The page number (0-based).
+            output_path (str): Path to save the image file to.
+            
+        Returns:
+            str: Path to the saved image file.
+        """
+        try:
+            # Apply contrast enhancement if needed, then build a PIL Image from the pixels.
+            # samples_mv avoids the bytes copy that pixmap.samples makes on every access.
+            if self.contrast_factor != 1.0:
+                logger.debug(f"Applying contrast enhancement with factor {self.contrast_factor}")
+                samples = self._enhance_contrast(np.frombuffer(samples, dtype=np.uint8))
+            img = Image.frombuffer("RGB", (width, height), samples, "raw", "RGB", 0, 1)
+            
+            # Save the image
+            if self.image_format == "jpg" or self.image_format == "jpeg":
+                img.save(output_path, format="JPEG", quality=self.quality)
+            elif self.image_format == "png":
+                img.save(output_path, format="PNG", quality=self.quality)
+            else:
+                img.save(output_path)
+                
+            logger.info(f"Saved page {page_num + 1} to {output_path}")
+            return output_path
+            
+        except Exception as e:
+            logger.error(f"Error processing page {page_num + 1}: {str(e)}")
+            logger.debug(traceback.format_exc())
+            return None
+
+    def _enhance_contrast(self, samples):
+        """
+        Apply contrast enhancement to raw RGB samples with a lookup table.
+        
+        Equivalent to PIL's ImageEnhance.Contrast: every channel value is pushed
+        away from the mean grey level of the page by the contrast factor.
+        
+        Args:
+            samples (numpy.ndarray): Flat uint8 array of interleaved RGB values.
+            
+        Returns:
+            numpy.ndarray: The enhanced samples.
+        """
+        # Mean of the greyscale (ITU-R 601-2 luma) image
+        channel_means = samples.reshape(-1, 3).mean(axis=0)
+        mean = int(np.dot(channel_means, (0.299, 0.587, 0.114)) + 0.5)
+        
+        lut = np.clip(mean + self.contrast_factor * (self._levels - mean), 0, 255).astype(np.uint8)
+        return lut[samples]
+
     def convert_all_pages_to_png(self):
         """
         Convert all pages of the PDF to PNG images.
         
+        Pages are rendered one by one on the calling thread, because PyMuPDF is
+        not thread safe. Their contrast enhancement and encoding, which take most
+        of the time, run concurrently on a thread pool.
+        
         Returns:
             list: List of paths to the saved image files.
         """
         try:
             logger.info(f"Converting all pages in {self.pdf_path} to {self.image_format}")
             
-            # Open the PDF file
-            try:
-                pdf_document = fitz.open(self.pdf_path)
-            except Exception as e:
-                logger.error(f"Failed to open PDF file: {str(e)}")
-                return []
+            # Get the number of pages
+            num_pages = self._num_pages
+            logger.info(f"PDF has {num_pages} pages")
                 
-            try:
-                # Get the number of pages
-                num_pages = len(pdf_document)
-                logger.info(f"PDF has {num_pages} pages")
+            output_paths = [None] * num_pages
+            
+            # Rendered pages waiting to be saved, their pixmaps are kept (and released) on this thread
+            pending = deque()
+            
+            def collect_oldest():
+                page_num, pixmap, future = pending.popleft()
+                output_paths[page_num] = future.result()
                 
+            try:
                 # Convert each page
-                output_paths = []
-                for page_num in range(num_pages):
-                    output_path = self.convert_page_to_png(page_num)
-                    if output_path:
-                        output_paths.append(output_path)
+                with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                    for page_num in range(num_pages):
+                        # Keep at most one rendered page per worker, rendering is much faster than encoding
+                        if len(pending) >= self.max_workers:
+                            collect_oldest()
+                            
+                        try:
+                            output_path, pixmap = self._render_page(page_num)
+                        except Exception as e:
+                            logger.error(f"Error processing page {page_num + 1}: {str(e)}")
+                            logger.debug(traceback.format_exc())
+                            continue
+                            
+                        if pixmap is None:
+                            output_paths[page_num] = output_path
+                            continue
+                            
+                        future = executor.submit(self._save_samples, pixmap.samples_mv, pixmap.width, pixmap.height, page_num, output_path)
+                        pending.append((page_num, pixmap, future))
+                        
+                    while pending:
+                        collect_oldest()
+                        
+                output_paths = [path for path in output_paths if path]
                         
                 logger.info(f"Successfully converted {len(output_paths)} out of {num_pages} pages")
                 return output_paths
@@ -162,12 +263,7 @@ class PDFtoPNGConverter:
                 logger.debug(traceback.format_exc())
                 return []
                 
-            finally:
-                # Close the PDF document
-                pdf_document.close()
-                
         except Exception as e:
             logger.error(f"Unexpected error converting PDF: {str(e)}")
             logger.debug(traceback.format_exc())
             return []
-